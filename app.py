@@ -1,10 +1,10 @@
 import streamlit as st
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from matplotlib.patches import Circle, Rectangle, Arc
-from PIL import Image
-import io
+import math
+import bisect
+import threading
+from collections import namedtuple
+from pathlib import Path
 
 # Page configuration
 st.set_page_config(
@@ -14,7 +14,7 @@ st.set_page_config(
 )
 
 # Logo path (local file in main directory)
-LOGO_PATH = "logo.png"
+LOGO_PATH = Path("logo.png")
 
 # Vessel name options - REORDERED: RRA before LRA
 VESSEL_OPTIONS = [
@@ -30,8 +30,19 @@ VESSEL_OPTIONS = [
     "F5"
 ]
 
+# Custom fenestration names, which stay available after being used
+CUSTOM_VESSELS = frozenset(vessel for vessel in VESSEL_OPTIONS if vessel.startswith("F"))
+
+# One placed fenestration; size and short label are stored with it when it is added
+Fenestration = namedtuple('Fenestration', 'id vessel position clock size short')
+
+# Mapping that falls back to the key itself, so unknown vessels are labelled with their own name
+class IdentityFallbackDict(dict):
+    def __missing__(self, key):
+        return key
+
 # Short names for display on template
-VESSEL_SHORT_NAMES = {
+VESSEL_SHORT_NAMES = IdentityFallbackDict({
     "Celiac Trunk": "CT",
     "SMA": "SMA",
     "LRA": "LRA",
@@ -42,104 +53,213 @@ VESSEL_SHORT_NAMES = {
     "F3": "F3",
     "F4": "F4",
     "F5": "F5"
-}
-
-# Function to convert clock position to X fraction on template
-def clock_to_x_fraction(clock_position):
-    if clock_position == 6:
-        return 0.0
-    elif clock_position == 7:
-        return 1/12
-    elif clock_position == 8:
-        return 2/12
-    elif clock_position == 9:
-        return 3/12
-    elif clock_position == 10:
-        return 4/12
-    elif clock_position == 11:
-        return 5/12
-    elif clock_position == 12:
-        return 6/12
-    elif clock_position == 1:
-        return 7/12
-    elif clock_position == 2:
-        return 8/12
-    elif clock_position == 3:
-        return 9/12
-    elif clock_position == 4:
-        return 10/12
-    elif clock_position == 5:
-        return 11/12
-    return 0.5
+})
+
+# Clock positions along the unwrapped template, left to right
+TEMPLATE_CLOCK_ORDER = [6, 7, 8, 9, 10, 11, 12, 1, 2, 3, 4, 5, 6]
+
+# Text style of the fenestration labels in the 3D view
+FEN_LABEL_STYLE = {'fontsize': 10, 'fontweight': 'bold'}
+
+# Back half of the top ellipse in the 3D view (0 to -180 degrees), drawn dotted; it never changes
+# 40 points are plenty for an arc this small on screen
+TOP_BACK_ARC_THETA = np.linspace(0, -math.pi, 40)
+TOP_BACK_ARC_X = 80 * np.cos(TOP_BACK_ARC_THETA)
+TOP_BACK_ARC_Y = 100 + 30 * np.sin(TOP_BACK_ARC_THETA)
+
+# Template clock lines as (x fraction of the circumference, clock, is_major), computed once at load
+TEMPLATE_CLOCK_LINES = [(i / 12, clock, clock in [12, 3, 6, 9]) for i, clock in enumerate(TEMPLATE_CLOCK_ORDER)]
+
+# Function to convert an array of clock positions to X fractions on the template
+# 6 o'clock sits at the left edge and each hour adds 1/12 of the circumference
+def clocks_to_x_fraction(clocks):
+    return np.mod(clocks - 6, 12) / 12
+
+# Function to convert an array of clock positions to X coordinates in the 3D graft view
+# Triangle wave over the clock face: 0 at 12 and 6, +80 at 3, -80 at 9 (graft sides at -80 and 80)
+def clocks_to_x_3d(clocks):
+    return (80 / 3) * (3 - np.abs(np.mod(clocks + 3, 12) - 6))
+
+# Function to check which fenestrations in an array of clock positions are behind the graft (4 to 8 o'clock)
+def clocks_behind_graft(clocks):
+    return np.mod(clocks - 4, 12) <= 4
 
 # Function to check if fenestration is behind the graft (posterior side)
 def is_behind_graft(clock_position):
     return clock_position in [4, 5, 6, 7, 8]
 
+# Function to split the fenestrations into per-field columns (clocks, positions, sizes, short names)
+# The result is a hashable tuple of tuples, used as the cache key for the views and the PDF
+def fenestration_columns(fens):
+    clocks = tuple(fen.clock for fen in fens)
+    positions = tuple(fen.position for fen in fens)
+    sizes = tuple(fen.size for fen in fens)
+    short_names = tuple(fen.short for fen in fens)
+    return clocks, positions, sizes, short_names
+
+# Function to turn the clock, position and size columns into NumPy arrays
+def fenestration_arrays(fen_cols):
+    clocks, positions, sizes, _ = fen_cols
+    return np.array(clocks, dtype=int), np.array(positions, dtype=float), np.array(sizes, dtype=float)
+
 # Function to load logo from local file
-@st.cache_data
+# Cached as a shared resource (no copy per call), so the array is made read-only
+@st.cache_resource
 def load_logo():
+    from PIL import Image
+    
+    # A missing logo is expected (optional asset); only an unreadable one is caught below
+    if not LOGO_PATH.is_file():
+        return None
     try:
-        img = Image.open(LOGO_PATH)
-        return np.array(img)
-    except:
+        logo = np.array(Image.open(LOGO_PATH))
+    except OSError:  # Includes PIL.UnidentifiedImageError
         return None
+    logo.setflags(write=False)
+    return logo
+
+# Function to get the logo as RGBA with its alpha already halved (the 50% transparency used everywhere)
+@st.cache_resource
+def load_faded_logo():
+    logo_img = load_logo()
+    if logo_img is None:
+        return None
+    if logo_img.ndim == 3 and logo_img.shape[2] == 4:
+        faded = logo_img.copy()
+    else:
+        rgb = np.dstack([logo_img] * 3) if logo_img.ndim == 2 else logo_img
+        faded = np.dstack([rgb, np.full(rgb.shape[:2], 255, dtype=np.uint8)])
+    faded[..., 3] //= 2
+    faded.setflags(write=False)
+    return faded
 
 # Function to get available vessel options
+# Uses the used_vessels set kept in session state instead of scanning the fenestrations
 def get_available_vessels():
-    used_vessels = [fen['vessel'] for fen in st.session_state.fenestrations]
-    available = []
-    for vessel in VESSEL_OPTIONS:
-        if vessel.startswith("F") or vessel not in used_vessels:
-            available.append(vessel)
-    return available
+    # Custom fenestrations (F1-F5) can be reused, so only named vessels are ever taken
+    taken = st.session_state.used_vessels - CUSTOM_VESSELS
+    return [vessel for vessel in VESSEL_OPTIONS if vessel not in taken]
 
-# Initialize session state
-if 'fenestrations' not in st.session_state:
-    st.session_state.fenestrations = []
+# Function to configure matplotlib once per process, before the first figure is built
+# Headless Agg backend, no interactive machinery, cheaper path rendering
+@st.cache_resource
+def setup_matplotlib():
+    import matplotlib
+    
+    matplotlib.use('Agg')
+    matplotlib.rcParams.update({
+        'interactive': False,
+        'figure.max_open_warning': 0,
+        'figure.autolayout': False,
+        'path.simplify': True,
+        'path.simplify_threshold': 1.0,
+        'agg.path.chunksize': 10000
+    })
 
-# Load logo
-logo_img = load_logo()
+# Function to add fenestration circles as a single collection instead of one Circle patch each
+# Sizes are in data units (units='xy'), so radii stay true to the mm scale unlike scatter markers
+# Returns the added artists so the caller can remove them again
+def add_fenestration_circles(ax, xs, ys, radii, **kwargs):
+    from matplotlib.collections import EllipseCollection
+    
+    if len(xs) == 0:
+        return []
+    diameters = 2 * radii
+    circles = EllipseCollection(diameters, diameters, 0, units='xy', offsets=np.column_stack([xs, ys]),
+                                offset_transform=ax.transData, color='red', **kwargs)
+    ax.add_collection(circles)
+    return [circles]
 
-# Title and description
-st.title("🏥 PMEG Template Generator")
-st.markdown("**Proof of Concept for Physician-Modified Endograft Template Generation**")
-st.markdown("Design fenestrations on vascular grafts and generate printable templates")
-
-# Sidebar controls
-st.sidebar.header("Graft Configuration")
-graft_diameter = st.sidebar.selectbox(
-    "Graft Diameter (mm)", 
-    [20, 24, 28, 32, 36], 
-    index=2
-)
-graft_length = st.sidebar.slider("Graft Length (mm)", 80, 200, 120)
-fenestration_size = st.sidebar.slider("Fenestration Size (mm)", 4, 12, 6)
-
-st.sidebar.header("Fenestration Controls")
-if st.sidebar.button("Clear All Fenestrations", type="secondary"):
-    st.session_state.fenestrations = []
-    st.rerun()
+# Function to get the BatchText artist class: one artist that draws a batch of labels in a single draw call
+# Defined lazily (and once per process) so matplotlib is only imported when a figure is built
+@st.cache_resource
+def batch_text_class():
+    from matplotlib.artist import Artist
+    from matplotlib.font_manager import FontProperties
+    
+    class BatchText(Artist):
+        def __init__(self, xs, ys, labels, fontsize=10, fontweight='normal', color='black', **kwargs):
+            super().__init__()
+            self._xy = np.column_stack([xs, ys])
+            self._labels = list(labels)
+            self._prop = FontProperties(size=fontsize, weight=fontweight)
+            self._color = color
+            self.set(**kwargs)
+        
+        def draw(self, renderer):
+            if not self.get_visible() or not self._labels:
+                return
+            gc = renderer.new_gc()
+            gc.set_foreground(self._color)
+            gc.set_alpha(self.get_alpha())
+            gc.set_url(self.get_url())
+            points = self.get_transform().transform(self._xy)
+            if renderer.flipy():
+                points[:, 1] = renderer.get_canvas_width_height()[1] - points[:, 1]
+            # Labels are left/baseline aligned at their anchor point, like ax.text defaults
+            for (x, y), label in zip(points, self._labels):
+                renderer.draw_text(gc, x, y, label, self._prop, 0)
+            gc.restore()
+            self.stale = False
+    
+    return BatchText
 
-# Main layout
-col1, col2 = st.columns(2)
+# Function to add a batch of labels as one BatchText artist, returning the added artists
+def add_batch_labels(ax, xs, ys, labels, **kwargs):
+    if len(xs) == 0:
+        return []
+    batch = batch_text_class()(xs, ys, labels, **kwargs)
+    ax.add_artist(batch)
+    return [batch]
 
-with col1:
-    st.subheader("3D Graft View")
-    st.markdown("*Add fenestrations using clock positions (12 o'clock = anterior)*")
-    
-    fig1, ax1 = plt.subplots(figsize=(8, 7))
-    ax1.set_xlim(-150, 160)
-    ax1.set_ylim(-160, 160)
-    
+# Function to draw the fenestrations onto the 3D graft view, returning the added artists
+def draw_fenestrations_3d(ax1, fen_cols, graft_length):
     # Calculate scaling factor for accurate representation
     # The graft HEIGHT in the plot is 200 units (from -100 to 100)
     # This represents the graft length in mm
     scale_factor = 200 / graft_length  # units per mm for Y-axis (vertical)
     
+    clocks, positions, sizes = fenestration_arrays(fen_cols)
+    xs = clocks_to_x_3d(clocks)
+    ys = 100 - (positions / graft_length) * 200
+    # Scale fenestration radius properly based on the Y-axis scale (vertical)
+    radii = (sizes / 2) * scale_factor
+    behind = clocks_behind_graft(clocks)
+    label_xs = xs + radii + 2
+    short_names = np.array(fen_cols[3], dtype=object)
+    
+    # Draw fenestrations BEHIND the graft first (lower z-order)
+    # 50% transparency for fenestrations behind the graft
+    artists = add_fenestration_circles(ax1, xs[behind], ys[behind], radii[behind], alpha=0.35, zorder=3)
+    artists += add_batch_labels(ax1, label_xs[behind], ys[behind], short_names[behind],
+                                alpha=0.5, zorder=3, **FEN_LABEL_STYLE)
+    
+    # Draw fenestrations IN FRONT of the graft (higher z-order)
+    # Full opacity for fenestrations in front
+    artists += add_fenestration_circles(ax1, xs[~behind], ys[~behind], radii[~behind], alpha=0.7, zorder=5)
+    artists += add_batch_labels(ax1, label_xs[~behind], ys[~behind], short_names[~behind],
+                                zorder=5, **FEN_LABEL_STYLE)
+    return artists
+
+# Function to build the static part of the 3D graft view (everything except fenestrations and title)
+# The outline does not depend on the diameter, so it is cached per length only
+# and shared across reruns; the lock guards the overlay step
+@st.cache_resource(max_entries=64)
+def build_base_3d(graft_length):
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
+    from matplotlib.patches import Arc, Ellipse
+    
+    setup_matplotlib()
+    
+    fig1 = Figure(figsize=(8, 7))
+    ax1 = fig1.add_subplot()
+    ax1.set_xlim(-150, 160)
+    ax1.set_ylim(-160, 160)
+    
     # Draw top ellipse - FILLED completely with graft color (not visible from front)
-    ellipse_top_fill = patches.Ellipse((0, 100), 160, 60, linewidth=0, 
-                                       facecolor='lightblue', alpha=0.3, zorder=1)
+    ellipse_top_fill = Ellipse((0, 100), 160, 60, linewidth=0, 
+                               facecolor='lightblue', alpha=0.3, zorder=1)
     ax1.add_patch(ellipse_top_fill)
     
     # Draw top ellipse - TOP HALF (solid line - visible part)
@@ -150,18 +270,15 @@ with col1:
     
     # Draw top ellipse - BOTTOM HALF (dotted line - part curving away)
     # Bottom arc: from 0 to -180 degrees (right to left, lower half)
-    theta = np.linspace(0, -np.pi, 100)
-    x_bottom = 80 * np.cos(theta)
-    y_bottom = 100 + 30 * np.sin(theta)
-    ax1.plot(x_bottom, y_bottom, 'k:', linewidth=2, alpha=0.6, zorder=2)
+    ax1.plot(TOP_BACK_ARC_X, TOP_BACK_ARC_Y, 'k:', linewidth=2, alpha=0.6, zorder=2)
     
     # Draw cylinder body (sides)
-    ax1.plot([-80, -80], [-100, 100], 'k-', linewidth=2.5, zorder=2)
-    ax1.plot([80, 80], [-100, 100], 'k-', linewidth=2.5, zorder=2)
+    ax1.add_collection(LineCollection([[(-80, -100), (-80, 100)], [(80, -100), (80, 100)]],
+                                      colors='black', linewidths=2.5, capstyle='projecting', zorder=2))
     
     # Draw bottom ellipse (fully visible, same color as shaft)
-    ellipse_bottom = patches.Ellipse((0, -100), 160, 60, linewidth=2, 
-                                   edgecolor='black', facecolor='lightblue', alpha=0.3, zorder=2)
+    ellipse_bottom = Ellipse((0, -100), 160, 60, linewidth=2, 
+                             edgecolor='black', facecolor='lightblue', alpha=0.3, zorder=2)
     ax1.add_patch(ellipse_bottom)
     
     # Clock position labels
@@ -172,207 +289,428 @@ with col1:
     
     # Y-axis labels (distance from top) - dotted lines extend to numbers
     y_ticks = [0, graft_length//4, graft_length//2, 3*graft_length//4, graft_length]
-    for tick in y_ticks:
-        y_pos = 100 - (tick / graft_length) * 200
-        # Draw gray dotted line from left edge through graft to the number
-        ax1.plot([-80, 120], [y_pos, y_pos], color='gray', linestyle=':', linewidth=1, alpha=0.6, zorder=0)
+    y_positions = [100 - (tick / graft_length) * 200 for tick in y_ticks]
+    # Gray dotted lines from left edge through graft to the numbers, as one collection
+    ax1.add_collection(LineCollection([[(-80, y_pos), (120, y_pos)] for y_pos in y_positions],
+                                      colors='gray', linestyles=':', linewidths=1, alpha=0.6, zorder=0))
+    for tick, y_pos in zip(y_ticks, y_positions):
         # Text label
         ax1.text(125, y_pos, f"{tick}", fontsize=9, ha='left', va='center', color='darkgreen', zorder=10)
     
     ax1.text(140, 0, "mm", fontsize=9, ha='left', va='center', color='darkgreen', rotation=90, zorder=10)
     
-    # Draw fenestrations BEHIND the graft first (lower z-order)
-    for i, fen in enumerate(st.session_state.fenestrations):
-        if is_behind_graft(fen['clock']):
-            clock = fen['clock']
-            if clock == 12:
-                x = 0
-            elif clock == 9:
-                x = -80
-            elif clock == 3:
-                x = 80
-            elif clock == 6:
-                x = 0
-            elif clock in [10, 11]:
-                x = -80 + (clock - 9) * (80 / 3)
-            elif clock in [1, 2]:
-                x = clock * (80 / 3)
-            elif clock in [4, 5]:
-                x = 80 - (clock - 3) * (80 / 3)
-            elif clock in [7, 8]:
-                x = -80 + (9 - clock) * (80 / 3)
-            else:
-                x = 0
-            
-            y = 100 - (fen['position'] / graft_length) * 200
-            
-            # Use the stored fenestration size for this specific fenestration
-            fen_size = fen.get('size', 6)  # Default to 6 if not stored (backward compatibility)
-            # Scale fenestration radius properly based on the Y-axis scale (vertical)
-            fen_radius_scaled = (fen_size / 2) * scale_factor
-            
-            # 50% transparency for fenestrations behind the graft
-            circle = Circle((x, y), fen_radius_scaled, color='red', alpha=0.35, zorder=3)
-            ax1.add_patch(circle)
-            short_name = VESSEL_SHORT_NAMES.get(fen['vessel'], fen['vessel'])
-            ax1.text(x + fen_radius_scaled + 2, y, short_name, fontsize=10, fontweight='bold', alpha=0.5, zorder=3)
-    
-    # Draw fenestrations IN FRONT of the graft (higher z-order)
-    for i, fen in enumerate(st.session_state.fenestrations):
-        if not is_behind_graft(fen['clock']):
-            clock = fen['clock']
-            if clock == 12:
-                x = 0
-            elif clock == 9:
-                x = -80
-            elif clock == 3:
-                x = 80
-            elif clock == 6:
-                x = 0
-            elif clock in [10, 11]:
-                x = -80 + (clock - 9) * (80 / 3)
-            elif clock in [1, 2]:
-                x = clock * (80 / 3)
-            elif clock in [4, 5]:
-                x = 80 - (clock - 3) * (80 / 3)
-            elif clock in [7, 8]:
-                x = -80 + (9 - clock) * (80 / 3)
-            else:
-                x = 0
-            
-            y = 100 - (fen['position'] / graft_length) * 200
-            
-            # Use the stored fenestration size for this specific fenestration
-            fen_size = fen.get('size', 6)  # Default to 6 if not stored (backward compatibility)
-            # Scale fenestration radius properly based on the Y-axis scale (vertical)
-            fen_radius_scaled = (fen_size / 2) * scale_factor
-            
-            # Full opacity for fenestrations in front
-            circle = Circle((x, y), fen_radius_scaled, color='red', alpha=0.7, zorder=5)
-            ax1.add_patch(circle)
-            short_name = VESSEL_SHORT_NAMES.get(fen['vessel'], fen['vessel'])
-            ax1.text(x + fen_radius_scaled + 2, y, short_name, fontsize=10, fontweight='bold', zorder=5)
-    
     ax1.text(0, 150, "TOP (Proximal) - 0mm", fontsize=10, ha='center', color='green', fontweight='bold', zorder=10)
     ax1.text(0, -145, f"BOTTOM (Distal) - {graft_length}mm", fontsize=10, ha='center', color='green', fontweight='bold', zorder=10)
     
-    ax1.set_title(f"Graft: {graft_diameter}mm x {graft_length}mm")
     ax1.set_aspect('equal')
     ax1.axis('off')
     
     # Add logo to bottom right - half size with 50% transparency
+    logo_img = load_faded_logo()
     if logo_img is not None:
         ax_logo1 = fig1.add_axes([0.80, 0.05, 0.075, 0.075])
-        ax_logo1.imshow(logo_img, alpha=0.5)
+        ax_logo1.imshow(logo_img)
         ax_logo1.axis('off')
     
-    st.pyplot(fig1)
-    plt.close(fig1)
+    return fig1, ax1, threading.Lock()
+
+# Function to lay out the unwrapped template in mm, with y growing downward from the top of the graft
+# Shared by the on-screen SVG and the PDF, so both place clock lines and fenestrations identically
+# Returns the clock lines as (x, clock, is_major) and the fenestrations as (x, y, radius, label)
+def template_layout(circumference, graft_length, fen_cols):
+    clock_lines = [(frac * circumference, clock, major) for frac, clock, major in TEMPLATE_CLOCK_LINES]
+    
+    clocks, positions, sizes = fenestration_arrays(fen_cols)
+    xs = clocks_to_x_fraction(clocks) * circumference
+    radii = sizes / 2
+    fenestrations = list(zip(xs.tolist(), positions.tolist(), radii.tolist(), fen_cols[3]))
+    return clock_lines, fenestrations
+
+# Function to build the printable PDF template
+# Drawn directly with ReportLab in millimetres on an A4 page, so the template prints at true 1:1 scale
+# Cached on the inputs, so re-preparing an unchanged template returns the stored bytes
+@st.cache_data(max_entries=32)
+def build_pdf(graft_diameter, graft_length, fen_cols):
+    import io
+    from PIL import Image
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+    
+    page_width, page_height = A4
+    circumference = math.pi * graft_diameter
+    
+    # Template origin (top-left corner); template y runs downward from the top of the graft
+    left = 25 * mm
+    top = page_height - 35 * mm
     
-    st.markdown("**Add Fenestration:**")
+    buf = io.BytesIO()
+    clock_lines, fenestrations = template_layout(circumference, graft_length, fen_cols)
+    c = canvas.Canvas(buf, pagesize=A4, invariant=1)
+    c.setTitle(f"Graft Template - {graft_diameter}mm x {graft_length}mm")
+    c.setCreator("PMEG Template Generator")
+    
+    c.setFont("Helvetica", 12)
+    c.drawString(left, page_height - 15 * mm, 
+                 f"Graft Template - {graft_diameter}mm x {graft_length}mm - SCALE 1:1 - Print at 100%")
+    
+    # Light grid and axis labels every 20mm
+    c.setStrokeColor(colors.lightgrey)
+    c.setLineWidth(0.5)
+    c.setFont("Helvetica", 8)
+    c.setFillColor(colors.black)
+    for y in range(0, graft_length + 1, 20):
+        c.line(left, top - y * mm, left + circumference * mm, top - y * mm)
+        c.drawRightString(left - 2 * mm, top - y * mm - 3, str(y))
+    for x in range(0, int(circumference) + 1, 20):
+        c.line(left + x * mm, top, left + x * mm, top - graft_length * mm)
+        c.drawCentredString(left + x * mm, top - (graft_length + 5) * mm, str(x))
+    c.setFont("Helvetica", 10)
+    c.drawCentredString(left + circumference / 2 * mm, top - (graft_length + 11) * mm, "Circumference (mm)")
+    c.saveState()
+    c.translate(left - 12 * mm, top - graft_length / 2 * mm)
+    c.rotate(90)
+    c.drawCentredString(0, 0, "Distance from Top (mm)")
+    c.restoreState()
+    
+    # Graft outline
+    c.setStrokeColor(colors.black)
+    c.setLineWidth(2)
+    c.rect(left, top - graft_length * mm, circumference * mm, graft_length * mm, stroke=1, fill=0)
+    
+    # Clock lines and labels
+    for x, clock, major in clock_lines:
+        x = left + x * mm
+        c.saveState()
+        if major:
+            c.setStrokeColor(colors.blue, alpha=0.7)
+            c.setLineWidth(1.5)
+            c.setDash(5.5, 2.4)
+            c.setFont("Helvetica-Bold", 10)
+            c.setFillColor(colors.blue)
+        else:
+            c.setStrokeColor(colors.lightblue, alpha=0.5)
+            c.setLineWidth(1)
+            c.setDash(1, 1.65)
+            c.setFont("Helvetica", 9)
+            c.setFillColor(colors.grey)
+        c.line(x, top + 2 * mm, x, top - graft_length * mm)
+        c.drawCentredString(x, top + 5 * mm, str(clock))
+        c.restoreState()
+    
+    # Fenestrations
+    c.setFont("Helvetica-Bold", 10)
+    for x, y, r, name in fenestrations:
+        c.setFillColor(colors.red, alpha=0.7)
+        c.circle(left + x * mm, top - y * mm, r * mm, stroke=0, fill=1)
+        c.setFillColor(colors.black)
+        c.drawString(left + (x + r + 2) * mm, top - y * mm, name)
     
-    available_vessels = get_available_vessels()
-    new_vessel = st.selectbox(
-        "Vessel / Fenestration Name",
-        available_vessels,
-        index=0,
-        help="Select the target vessel or use F1, F2, etc. for custom fenestrations"
-    )
+    # Add scale verification marks
+    c.setFont("Helvetica-Bold", 9)
+    c.setFillColor(colors.red)
+    c.drawString(left, top - (graft_length + 18) * mm, f"Circumference: {circumference:.1f}mm")
+    c.setFont("Helvetica", 9)
+    c.setFillColor(colors.blue)
+    c.drawString(left, top - (graft_length + 23) * mm, f"Graft: {graft_diameter}mm diameter x {graft_length}mm length")
+    
+    # Add logo to bottom right with 50% transparency
+    faded = load_faded_logo()
+    if faded is not None:
+        logo_width = 20 * mm
+        logo_height = logo_width * faded.shape[0] / faded.shape[1]
+        c.drawImage(ImageReader(Image.fromarray(faded)), page_width - 15 * mm - logo_width, 15 * mm,
+                    width=logo_width, height=logo_height, mask='auto')
+    
+    c.showPage()
+    c.save()
+    return buf.getvalue()
+
+# Function to render a figure as SVG, so the browser gets vector output instead of a server-side PNG
+def figure_to_svg(fig):
+    import io
     
-    col1a, col1b = st.columns(2)
-    with col1a:
-        new_position = st.number_input("Position from top (mm)", 0, graft_length, 20)
-    with col1b:
-        new_clock = st.selectbox(
-            "Clock Position",
-            [12, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],
+    buf = io.StringIO()
+    fig.savefig(buf, format='svg')
+    return buf.getvalue()
+
+# Function to remove the fenestration artists drawn on top of a cached base figure
+def remove_overlay(artists):
+    for artist in artists:
+        artist.remove()
+
+# Function to render the 3D graft view with its fenestrations to SVG
+# Cached on the inputs: reruns that don't change the view, and repeat states
+# (e.g. re-adding a deleted fenestration, other sessions), skip matplotlib entirely
+@st.cache_data(max_entries=32)
+def render_3d_view(graft_diameter, graft_length, fen_cols):
+    fig1, ax1, lock1 = build_base_3d(graft_length)
+    
+    with lock1:
+        ax1.set_title(f"Graft: {graft_diameter}mm x {graft_length}mm")
+        artists = draw_fenestrations_3d(ax1, fen_cols, graft_length)
+        try:
+            return figure_to_svg(fig1)
+        finally:
+            remove_overlay(artists)
+
+# Function to encode the faded logo as a PNG data URI for embedding in SVG output
+@st.cache_data
+def logo_data_uri():
+    import io
+    import base64
+    from PIL import Image
+    
+    logo_img = load_faded_logo()
+    if logo_img is None:
+        return None
+    buf = io.BytesIO()
+    Image.fromarray(logo_img).save(buf, format='PNG')
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode('ascii')
+
+# Function to render the 2D template with its fenestrations to SVG
+# Written out directly in mm units (y grows downward, like the template), no matplotlib involved
+@st.cache_data(max_entries=32)
+def render_2d_view(circumference, graft_length, fen_cols):
+    from html import escape
+    
+    # Plot area spans -5..circumference+10 across and -15..graft_length+10 down; margins hold the labels
+    x0, x1 = -5, circumference + 10
+    y0, y1 = -15, graft_length + 10
+    left, top = x0 - 18, y0 - 9
+    width = (x1 + 4) - left
+    height = (y1 + 15) - top
+    
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.1f}mm" height="{height:.1f}mm" '
+        f'viewBox="{left:.2f} {top:.2f} {width:.2f} {height:.2f}" '
+        f'font-family="DejaVu Sans, Arial, sans-serif">',
+        f'<rect x="{left:.2f}" y="{top:.2f}" width="{width:.2f}" height="{height:.2f}" fill="white"/>',
+        f'<text x="{(x0 + x1) / 2:.2f}" y="{y0 - 3:.2f}" font-size="3.9" text-anchor="middle">'
+        f'Printable Template - Full Circumference - Scale 1:1</text>',
+    ]
+    
+    clock_lines, fenestrations = template_layout(circumference, graft_length, fen_cols)
+    
+    # Graft outline
+    parts.append(f'<rect x="0" y="0" width="{circumference:.2f}" height="{graft_length}" '
+                 f'fill="lightgray" fill-opacity="0.3" stroke="black" stroke-width="0.7"/>')
+    
+    # Grid and tick labels every 20mm
+    for x in range(0, int(x1) + 1, 20):
+        parts.append(f'<line x1="{x}" y1="{y0}" x2="{x}" y2="{y1}" stroke="#b0b0b0" stroke-width="0.28" stroke-opacity="0.3"/>')
+        parts.append(f'<text x="{x}" y="{y1 + 4.5}" font-size="3.5" text-anchor="middle">{x}</text>')
+    for y in range(0, int(y1) + 1, 20):
+        parts.append(f'<line x1="{x0}" y1="{y}" x2="{x1:.2f}" y2="{y}" stroke="#b0b0b0" stroke-width="0.28" stroke-opacity="0.3"/>')
+        parts.append(f'<text x="{x0 - 1.5}" y="{y + 1.2}" font-size="3.5" text-anchor="end">{y}</text>')
+    
+    # Clock lines and labels
+    # One path per line style, each holding all of its vertical segments
+    major_path = "".join(f"M{x:.2f} {y0}V{y1}" for x, _, major in clock_lines if major)
+    minor_path = "".join(f"M{x:.2f} {y0}V{y1}" for x, _, major in clock_lines if not major)
+    parts.append(f'<path d="{major_path}" fill="none" stroke="blue" stroke-width="0.53" '
+                 f'stroke-dasharray="1.96 0.85" stroke-opacity="0.7"/>')
+    parts.append(f'<path d="{minor_path}" fill="none" stroke="lightblue" stroke-width="0.35" '
+                 f'stroke-dasharray="0.35 0.58" stroke-opacity="0.5"/>')
+    for x, clock, major in clock_lines:
+        if major:
+            parts.append(f'<text x="{x:.2f}" y="-5" font-size="3.9" text-anchor="middle" fill="blue" font-weight="bold">{clock}</text>')
+        else:
+            parts.append(f'<text x="{x:.2f}" y="-5" font-size="3.2" text-anchor="middle" fill="gray">{clock}</text>')
+    
+    # Fenestrations
+    for x, y, r, name in fenestrations:
+        parts.append(f'<circle cx="{x:.2f}" cy="{y:.2f}" r="{r:.2f}" fill="red" fill-opacity="0.7"/>')
+        parts.append(f'<text x="{x + r + 2:.2f}" y="{y:.2f}" font-size="3.5" font-weight="bold">{escape(name)}</text>')
+    
+    # Plot frame and axis labels
+    parts.append(f'<rect x="{x0}" y="{y0}" width="{x1 - x0:.2f}" height="{y1 - y0}" fill="none" stroke="black" stroke-width="0.28"/>')
+    parts.append(f'<text x="{(x0 + x1) / 2:.2f}" y="{y1 + 10}" font-size="3.5" text-anchor="middle">Circumference (mm)</text>')
+    parts.append(f'<text transform="translate({x0 - 13} {(y0 + y1) / 2:.2f}) rotate(-90)" font-size="3.5" '
+                 f'text-anchor="middle">Distance from Top (mm)</text>')
+    
+    # Add logo to bottom right - half size, already faded to 50% transparency
+    logo_uri = logo_data_uri()
+    if logo_uri is not None:
+        logo_size = 0.06 * width
+        parts.append(f'<image href="{logo_uri}" x="{x1 - logo_size - 1:.2f}" y="{y1 - logo_size - 1:.2f}" '
+                     f'width="{logo_size:.2f}" height="{logo_size:.2f}"/>')
+    
+    parts.append('</svg>')
+    return "\n".join(parts)
+
+# Function to render the "Add Fenestration" controls
+# The inputs sit in a form, so editing them does not rerun anything; only submitting does
+# Runs as a fragment, so a submit adds the fenestration before the one full rerun redraws the views
+@st.fragment
+def render_add_form(graft_length, fenestration_size):
+    st.markdown("**Add Fenestration:**")
+    
+    with st.form("add_fenestration", border=False):
+        available_vessels = get_available_vessels()
+        new_vessel = st.selectbox(
+            "Vessel / Fenestration Name",
+            available_vessels,
             index=0,
-            help="12 o'clock = anterior (front), 6 o'clock = posterior (back)"
+            help="Select the target vessel or use F1, F2, etc. for custom fenestrations"
         )
+        
+        col1a, col1b = st.columns(2)
+        with col1a:
+            new_position = st.number_input("Position from top (mm)", 0, graft_length, 20)
+        with col1b:
+            new_clock = st.selectbox(
+                "Clock Position",
+                [12, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],
+                index=0,
+                help="12 o'clock = anterior (front), 6 o'clock = posterior (back)"
+            )
+        
+        submitted = st.form_submit_button("Add Fenestration")
+    
+    if submitted:
+        # Keep the list ordered by position so the fenestration list never needs re-sorting
+        bisect.insort(st.session_state.fenestrations, Fenestration(
+            id=st.session_state.next_fen_id,
+            vessel=new_vessel,
+            position=new_position,
+            clock=new_clock,
+            size=fenestration_size,  # Store the size with each fenestration
+            short=VESSEL_SHORT_NAMES[new_vessel]  # Label drawn on the figures
+        ), key=lambda fen: fen.position)
+        st.session_state.next_fen_id += 1
+        st.session_state.used_vessels.add(new_vessel)
+        st.rerun()
+
+# Function to render the fenestration list as one table with a Delete checkbox column
+# Runs as a fragment, so ticking Delete goes straight to one full rerun with the updated list
+@st.fragment
+def render_fenestration_list():
+    if not st.session_state.fenestrations:
+        return
+    st.subheader("Fenestrations List")
+    rows = [{
+        'id': fen.id,
+        'Vessel': fen.vessel,
+        'Position (mm from top)': fen.position,
+        'Clock': fen.clock,
+        'Size (mm)': fen.size,
+        'Behind graft': is_behind_graft(fen.clock),
+        'Delete': False
+    } for fen in st.session_state.fenestrations]
+    edited = st.data_editor(
+        rows,
+        column_config={
+            'id': None,  # Hidden; identifies the row's fenestration
+            'Position (mm from top)': st.column_config.NumberColumn(format="%.1f"),
+            'Delete': st.column_config.CheckboxColumn(help="Tick to remove this fenestration")
+        },
+        disabled=['id', 'Vessel', 'Position (mm from top)', 'Clock', 'Size (mm)', 'Behind graft'],
+        hide_index=True,
+        num_rows="fixed",
+        width="stretch"
+    )
     
-    if st.button("Add Fenestration"):
-        st.session_state.fenestrations.append({
-            'vessel': new_vessel,
-            'position': new_position,
-            'clock': new_clock,
-            'size': fenestration_size  # Store the size with each fenestration
-        })
+    delete_ids = {row['id'] for row in edited if row['Delete']}
+    if delete_ids:
+        kept = []
+        for fen in st.session_state.fenestrations:
+            if fen.id in delete_ids:
+                st.session_state.used_vessels.discard(fen.vessel)
+            else:
+                kept.append(fen)
+        st.session_state.fenestrations = kept
         st.rerun()
 
+# Function to render the PDF download controls
+# Runs as a fragment: preparing the PDF reruns only this block, not the views and reference sections
+# The PDF is only built on request; a prepared PDF is offered until the template changes
+@st.fragment
+def render_pdf_download(graft_diameter, graft_length, fen_cols):
+    pdf_key = (graft_diameter, graft_length, fen_cols)
+    
+    if st.button("Prepare PDF for download", key="prep_pdf"):
+        st.session_state.pdf_bytes = build_pdf(graft_diameter, graft_length, fen_cols)
+        st.session_state.pdf_key = pdf_key
+    
+    if st.session_state.get('pdf_key') == pdf_key:
+        st.download_button(
+            label="📥 Download Template (PDF)",
+            data=st.session_state.pdf_bytes,
+            file_name=f"graft_template_{graft_diameter}mm_{graft_length}mm.pdf",
+            mime="application/pdf",
+            on_click="ignore"  # Downloading does not change anything, so skip the rerun
+        )
+
+# Initialize session state
+if 'fenestrations' not in st.session_state:
+    st.session_state.fenestrations = []
+# Upgrade fenestrations stored as dicts by earlier versions (no id, possibly no size) once
+if any(isinstance(fen, dict) for fen in st.session_state.fenestrations):
+    st.session_state.fenestrations = [
+        Fenestration(fen.get('id', fen_id), fen['vessel'], fen['position'], fen['clock'],
+                     fen.get('size', 6), VESSEL_SHORT_NAMES[fen['vessel']])
+        if isinstance(fen, dict) else fen
+        for fen_id, fen in enumerate(st.session_state.fenestrations)
+    ]
+# Vessels already placed; updated on add/delete/clear so it never has to be rebuilt
+if 'used_vessels' not in st.session_state:
+    st.session_state.used_vessels = {fen.vessel for fen in st.session_state.fenestrations}
+# Monotonic id per fenestration, so a row keeps its identity when the list is re-sorted or shrinks
+if 'next_fen_id' not in st.session_state:
+    st.session_state.next_fen_id = max((fen.id for fen in st.session_state.fenestrations), default=-1) + 1
+
+# Title and description
+st.title("🏥 PMEG Template Generator")
+st.markdown("**Proof of Concept for Physician-Modified Endograft Template Generation**")
+st.markdown("Design fenestrations on vascular grafts and generate printable templates")
+
+# Sidebar controls
+st.sidebar.header("Graft Configuration")
+graft_diameter = st.sidebar.selectbox(
+    "Graft Diameter (mm)", 
+    [20, 24, 28, 32, 36], 
+    index=2
+)
+graft_length = st.sidebar.slider("Graft Length (mm)", 80, 200, 120)
+fenestration_size = st.sidebar.slider("Fenestration Size (mm)", 4, 12, 6)
+
+# Unwrapped template width, computed once per rerun
+circumference = math.pi * graft_diameter
+
+# Column snapshot of the fenestrations, built once per rerun and shared by the views and the PDF
+fen_cols = fenestration_columns(st.session_state.fenestrations)
+
+st.sidebar.header("Fenestration Controls")
+if st.sidebar.button("Clear All Fenestrations", type="secondary"):
+    st.session_state.fenestrations = []
+    st.session_state.used_vessels = set()
+    st.rerun()
+
+# Main layout
+col1, col2 = st.columns(2)
+
+with col1:
+    st.subheader("3D Graft View")
+    st.markdown("*Add fenestrations using clock positions (12 o'clock = anterior)*")
+    
+    svg1 = render_3d_view(graft_diameter, graft_length, fen_cols)
+    st.image(svg1, width="stretch")
+    
+    render_add_form(graft_length, fenestration_size)
+
 with col2:
     st.subheader("2D Template (Unwrapped)")
     st.markdown("*Full circumference: 6 (posterior) → 12 (anterior) → 6 (posterior)*")
     st.markdown(f"**Print Scale: 1:1 (Actual size on A4 paper)**")
     
-    circumference = np.pi * graft_diameter
-    
-    # Set figure size to maintain accurate scale for A4 printing
-    # A4 is 210mm x 297mm, we use DPI to ensure accurate sizing
-    dpi = 25.4  # 1 inch = 25.4mm, so 1 DPI = 1mm
-    fig_width = (circumference + 15) / 25.4  # Convert mm to inches
-    fig_height = (graft_length + 25) / 25.4  # Convert mm to inches
-    
-    fig2, ax2 = plt.subplots(figsize=(fig_width, fig_height), dpi=100)
-    
-    rect = Rectangle((0, 0), circumference, graft_length, 
-                    linewidth=2, edgecolor='black', facecolor='lightgray', alpha=0.3)
-    ax2.add_patch(rect)
-    
-    clock_order = [6, 7, 8, 9, 10, 11, 12, 1, 2, 3, 4, 5, 6]
-    
-    for i, clock in enumerate(clock_order):
-        x = (i / 12) * circumference
-        
-        if clock in [12, 3, 6, 9]:
-            ax2.axvline(x=x, color='blue', linestyle='--', linewidth=1.5, alpha=0.7)
-            ax2.text(x, -5, str(clock), fontsize=11, ha='center', color='blue', fontweight='bold')
-        else:
-            ax2.axvline(x=x, color='lightblue', linestyle=':', linewidth=1, alpha=0.5)
-            ax2.text(x, -5, str(clock), fontsize=9, ha='center', color='gray')
-    
-    for i, fen in enumerate(st.session_state.fenestrations):
-        x_frac = clock_to_x_fraction(fen['clock'])
-        x = x_frac * circumference
-        y = fen['position']
-        
-        # Use the stored fenestration size for this specific fenestration
-        fen_size = fen.get('size', 6)  # Default to 6 if not stored (backward compatibility)
-        circle = Circle((x, y), fen_size/2, color='red', alpha=0.7)
-        ax2.add_patch(circle)
-        short_name = VESSEL_SHORT_NAMES.get(fen['vessel'], fen['vessel'])
-        ax2.text(x + fen_size/2 + 2, y, short_name, fontsize=10, fontweight='bold')
-    
-    ax2.set_aspect('equal')
-    ax2.set_xlim(-5, circumference + 10)
-    ax2.set_ylim(graft_length + 10, -15)
-    ax2.set_xlabel('Circumference (mm)', fontsize=10)
-    ax2.set_ylabel('Distance from Top (mm)', fontsize=10)
-    ax2.set_title(f'Printable Template - Full Circumference - Scale 1:1', fontsize=11)
-    ax2.grid(True, alpha=0.3)
-    
-    # Add logo to bottom right - half size with 50% transparency
-    if logo_img is not None:
-        ax_logo2 = fig2.add_axes([0.87, 0.05, 0.06, 0.06])
-        ax_logo2.imshow(logo_img, alpha=0.5)
-        ax_logo2.axis('off')
-    
-    st.pyplot(fig2)
-    plt.close(fig2)
+    svg2 = render_2d_view(circumference, graft_length, fen_cols)
+    st.image(svg2, width="stretch")
 
 # Fenestration list
-if st.session_state.fenestrations:
-    st.subheader("Fenestrations List")
-    sorted_fens = sorted(enumerate(st.session_state.fenestrations), key=lambda x: x[1]['position'])
-    for orig_idx, fen in sorted_fens:
-        col_a, col_b = st.columns([4, 1])
-        with col_a:
-            behind_text = " (Behind graft)" if is_behind_graft(fen['clock']) else ""
-            fen_size = fen.get('size', 6)  # Get stored size
-            st.write(f"**{fen['vessel']}:** Position: {fen['position']:.1f}mm from top, Clock: {fen['clock']} o'clock, Size: {fen_size}mm{behind_text}")
-        with col_b:
-            if st.button(f"Delete", key=f"del_{orig_idx}"):
-                st.session_state.fenestrations.pop(orig_idx)
-                st.rerun()
+render_fenestration_list()
 
 # Vessel reference
 st.subheader("🩺 Vessel Reference")
@@ -421,64 +759,7 @@ st.info("""
 
 # Download template
 if st.session_state.fenestrations:
-    fig_download, ax_download = plt.subplots(figsize=(14, 10))
-    
-    circumference = np.pi * graft_diameter
-    
-    rect = Rectangle((0, 0), circumference, graft_length, 
-                    linewidth=2, edgecolor='black', facecolor='white')
-    ax_download.add_patch(rect)
-    
-    clock_order = [6, 7, 8, 9, 10, 11, 12, 1, 2, 3, 4, 5, 6]
-    for i, clock in enumerate(clock_order):
-        x = (i / 12) * circumference
-        if clock in [12, 3, 6, 9]:
-            ax_download.axvline(x=x, color='blue', linestyle='--', linewidth=1.5, alpha=0.7)
-            ax_download.text(x, -5, f"{clock}", fontsize=10, ha='center', color='blue', fontweight='bold')
-        else:
-            ax_download.axvline(x=x, color='lightblue', linestyle=':', linewidth=1, alpha=0.5)
-            ax_download.text(x, -5, f"{clock}", fontsize=9, ha='center', color='gray')
-    
-    for i, fen in enumerate(st.session_state.fenestrations):
-        x_frac = clock_to_x_fraction(fen['clock'])
-        x = x_frac * circumference
-        y = fen['position']
-        # Use the stored fenestration size for this specific fenestration
-        fen_size = fen.get('size', 6)
-        circle = Circle((x, y), fen_size/2, color='red', alpha=0.7)
-        ax_download.add_patch(circle)
-        short_name = VESSEL_SHORT_NAMES.get(fen['vessel'], fen['vessel'])
-        ax_download.text(x + fen_size/2 + 2, y, short_name, fontsize=10, fontweight='bold')
-    
-    ax_download.set_aspect('equal')
-    ax_download.set_xlim(-5, circumference + 10)
-    ax_download.set_ylim(graft_length + 10, -15)
-    ax_download.set_xlabel('Circumference (mm)')
-    ax_download.set_ylabel('Distance from Top (mm)')
-    ax_download.set_title(f'Graft Template - {graft_diameter}mm x {graft_length}mm - SCALE 1:1 - Print at 100%')
-    ax_download.grid(True, alpha=0.3)
-    
-    # Add scale verification marks
-    ax_download.text(5, graft_length + 5, f"Circumference: {circumference:.1f}mm", fontsize=9, color='red', fontweight='bold')
-    ax_download.text(5, graft_length + 8, f"Graft: {graft_diameter}mm diameter x {graft_length}mm length", fontsize=9, color='blue')
-    
-    # Add logo to downloaded PDF - half size with 50% transparency
-    if logo_img is not None:
-        ax_logo_dl = fig_download.add_axes([0.88, 0.05, 0.05, 0.05])
-        ax_logo_dl.imshow(logo_img, alpha=0.5)
-        ax_logo_dl.axis('off')
-    
-    buf = io.BytesIO()
-    fig_download.savefig(buf, format='pdf', bbox_inches='tight', dpi=300)
-    buf.seek(0)
-    plt.close(fig_download)
-    
-    st.download_button(
-        label="📥 Download Template (PDF)",
-        data=buf.getvalue(),
-        file_name=f"graft_template_{graft_diameter}mm_{graft_length}mm.pdf",
-        mime="application/pdf"
-    )
+    render_pdf_download(graft_diameter, graft_length, fen_cols)
 
 # Footer
 st.markdown("---")